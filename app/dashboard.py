@@ -3,7 +3,8 @@
 import streamlit as st
 import pandas as pd
 import altair as alt
-from utils import get_db_engine, setup_logging
+import pyarrow as pa
+from utils import get_db_engine, read_sql_arrow, setup_logging
 import time 
 
 # Setup logger for this module
@@ -28,32 +29,149 @@ def get_engine():
     logger.info("Dashboard: Creating new database engine connection.")
     return get_db_engine()
 
-# --- Data Loading Function (CACHED) ---
-@st.cache_data(ttl=300)
-def load_data():
-    """Loads all data from the core_ecomm_sales table."""
+# --- Data Loading Functions (CACHED) ---
+# Every KPI and chart has its own aggregate query, so the GROUP BYs run in
+# PostgreSQL and only the rows that are actually drawn reach the dashboard.
+# Types pinned for every query: the timestamp, and the text columns the charts
+# group by, which would otherwise be inferred as integers when digit-only
+QUERY_COLUMNS = {
+    'invoicedate': pa.timestamp('us', tz='UTC'),
+    'description': pa.string(),
+    'country': pa.string(),
+    'category': pa.string()
+}
+
+# The raw explorer holds quantity in 32 bits; the money and ratio columns stay
+# float64, as float32 would display 2.55 as 2.549999952316284.
+# Its text columns are pinned too, so codes like '007' keep their leading zeros.
+RAW_SAMPLE_COLUMNS = {
+    **QUERY_COLUMNS,
+    'invoice': pa.string(),
+    'stockcode': pa.string(),
+    'customer_id': pa.string(),
+    'desc_low': pa.string(),
+    'quantity': pa.int32(),
+    'price': pa.float64(),
+    'margin': pa.float64(),
+    'profit': pa.float64(),
+    'total_sale': pa.float64()
+}
+
+def run_query(name, query, params=None, column_types=QUERY_COLUMNS):
+    """Runs a query against the warehouse and returns the result as a DataFrame."""
     try:
-        logger.info("Dashboard: Cache miss or manually cleared. Loading data from core_ecomm_sales.")
-        
-        # Simulate a database load time for better UX when refreshing
-        time.sleep(0.5) 
+        logger.info(f"Dashboard: Cache miss or manually cleared. Loading {name} from core_ecomm_sales.")
 
         engine = get_engine()
-        # Query the new core table
-        query = "SELECT * FROM core_ecomm_sales ORDER BY invoicedate DESC;"
-        df = pd.read_sql(query, con=engine)
-        
-        # Ensure 'invoicedate' is a datetime object for charting
-        if 'invoicedate' in df.columns:
-            df['invoicedate'] = pd.to_datetime(df['invoicedate'])
-        
-        logger.info(f"Dashboard: Loaded {len(df)} rows.")
+        # Stream the result through COPY into Arrow
+        table = read_sql_arrow(query, engine, params=params, column_types=column_types)
+        df = table.to_pandas()
+
+        logger.info(f"Dashboard: Loaded {len(df)} rows for {name}.")
         return df
     except Exception as e:
-        logger.error(f"Dashboard: Error loading data: {e}")
+        logger.error(f"Dashboard: Error loading {name}: {e}")
         st.error(f"Error loading data from database. Please check logs. Error: {e}")
         return pd.DataFrame() # Return empty DataFrame on error
 
+@st.cache_data(ttl=300)
+def load_kpis():
+    """Loads the headline metrics as a single row."""
+    # Simulate a database load time for better UX when refreshing
+    time.sleep(0.5) 
+
+    # Orders are counted over a SELECT DISTINCT subquery rather than with
+    # COUNT(DISTINCT), which always sorts; the subquery can hash-aggregate or
+    # read invoices straight off the (invoice, stockcode) primary key
+    query = """
+        SELECT
+            COUNT(*) AS line_items,
+            SUM(total_sale) AS total_revenue,
+            SUM(profit) AS total_profit,
+            (SELECT COUNT(*) FROM (SELECT DISTINCT invoice FROM core_ecomm_sales) AS invoices) AS total_orders,
+            AVG(margin) AS avg_margin
+        FROM core_ecomm_sales
+    """
+    return run_query("KPIs", query)
+
+@st.cache_data(ttl=300)
+def load_daily():
+    """Loads revenue and profit summed per (UTC) day, with days without sales as zero."""
+    # Days are generated across the whole range (in UTC), so gaps plot as zero
+    # rather than the line joining straight across them.
+    # No ORDER BY: Vega-Lite orders line points by their x value itself
+    query = """
+        WITH daily AS (
+            SELECT
+                date_trunc('day', invoicedate, 'UTC') AS day,
+                SUM(total_sale) AS total_sale,
+                SUM(profit) AS profit
+            FROM core_ecomm_sales
+            WHERE invoicedate IS NOT NULL
+            GROUP BY 1
+        )
+        SELECT
+            days.day AS invoicedate,
+            COALESCE(daily.total_sale, 0) AS total_sale,
+            COALESCE(daily.profit, 0) AS profit
+        FROM generate_series(
+            (SELECT MIN(day) FROM daily),
+            (SELECT MAX(day) FROM daily),
+            interval '1 day',
+            'UTC'
+        ) AS days(day)
+        LEFT JOIN daily ON daily.day = days.day
+    """
+    return run_query("daily sales", query)
+
+@st.cache_data(ttl=300)
+def load_top_products(n=10):
+    """Loads the top n products by quantity sold."""
+    query = """
+        SELECT description, SUM(quantity) AS "Total Quantity"
+        FROM core_ecomm_sales
+        WHERE description IS NOT NULL
+        GROUP BY description
+        ORDER BY "Total Quantity" DESC NULLS LAST
+        LIMIT %(n)s
+    """
+    return run_query("top products", query, params={'n': n})
+
+@st.cache_data(ttl=300)
+def load_top_countries_by_profit(n=10):
+    """Loads the top n countries by profit."""
+    query = """
+        SELECT country, SUM(profit) AS "Total Profit"
+        FROM core_ecomm_sales
+        WHERE country IS NOT NULL
+        GROUP BY country
+        ORDER BY "Total Profit" DESC NULLS LAST
+        LIMIT %(n)s
+    """
+    return run_query("top countries", query, params={'n': n})
+
+@st.cache_data(ttl=300)
+def load_top_categories(n=10):
+    """Loads the top n categories by revenue, excluding 'unclassified'."""
+    # The <> comparison also filters out NULL categories
+    query = """
+        SELECT category, SUM(total_sale) AS "Total Revenue"
+        FROM core_ecomm_sales
+        WHERE category <> 'unclassified'
+        GROUP BY category
+        ORDER BY "Total Revenue" DESC NULLS LAST
+        LIMIT %(n)s
+    """
+    return run_query("top categories", query, params={'n': n})
+
+@st.cache_data(ttl=300)
+def load_raw_sample(limit=5000):
+    """Loads the most recent line items for the raw data explorer."""
+    # ORDER BY ... LIMIT walks idx_core_invoicedate instead of sorting the table
+    query = "SELECT * FROM core_ecomm_sales ORDER BY invoicedate DESC LIMIT %(limit)s"
+    # 'invoicedate' already arrives as datetime64[us, UTC] from the Arrow parse
+    return run_query("raw sample", query, params={'limit': limit}, column_types=RAW_SAMPLE_COLUMNS)
+
 
 # --- Refresh Button Callback ---
 def refresh_data_callback():
@@ -84,29 +202,23 @@ with col_button:
 
 # --- Main Dashboard Logic ---
 try:
-    df = load_data()
+    kpis = load_kpis()
 
-    if df.empty:
+    if kpis.empty or kpis.at[0, 'line_items'] == 0:
         st.warning("No data found in the data warehouse. Please run the ETL process or add CSV files.")
         st.stop()
 
-    # --- Pre-Calculations ---
+    # --- Key Metrics ---
     st.header("Key Metrics")
     
-    # Calculate total sale per line item
-    df['total_sale'] = df['quantity'] * df['price']
-    
-    # Calculate high-level metrics
-    total_revenue = df['total_sale'].sum()
-    total_profit = df['profit'].sum()
-    total_orders = df['invoice'].nunique() # Count unique invoices
-    avg_margin = df['margin'].mean()
-
+    # High-level metrics are aggregated in the warehouse
+    # Read each scalar with .at, which keeps its column's dtype; iloc[0] would
+    # upcast the whole row to float64 and show the order count as 25,900.0
     col1, col2, col3, col4 = st.columns(4)
-    col1.metric("Total Revenue", f"${total_revenue:,.2f}")
-    col2.metric("Total Profit", f"${total_profit:,.2f}")
-    col3.metric("Total Orders", f"{total_orders:,}")
-    col4.metric("Average Margin", f"{avg_margin:.2%}") # Format as percentage
+    col1.metric("Total Revenue", f"${kpis.at[0, 'total_revenue']:,.2f}")
+    col2.metric("Total Profit", f"${kpis.at[0, 'total_profit']:,.2f}")
+    col3.metric("Total Orders", f"{kpis.at[0, 'total_orders']:,}")
+    col4.metric("Average Margin", f"{kpis.at[0, 'avg_margin']:.2%}") # Format as percentage
 
     st.markdown("---")
 
@@ -118,37 +230,43 @@ try:
     with col_chart1:
         # 1. Daily Revenue and Profit (Keep)
         st.subheader("Daily Revenue & Profit")
-        if 'invoicedate' in df.columns:
-            sales_over_time = df.set_index('invoicedate').resample('D')[['total_sale', 'profit']].sum().reset_index()
-            
+        sales_over_time = load_daily()
+
+        if not sales_over_time.empty:
             # Use Altair for the dual line chart
-            chart = alt.Chart(sales_over_time).mark_line().encode(
+            # A single chart folds both series into long form in Vega-Lite,
+            # so the daily data is serialized to the browser only once
+            chart = alt.Chart(sales_over_time).transform_fold(
+                ['total_sale', 'profit'], as_=['metric', 'value']
+            ).mark_line().encode(
                 x=alt.X('invoicedate:T', title='Date'),
-                y=alt.Y('total_sale:Q', title='Revenue'),
-                color=alt.value('darkblue')
-            ).interactive() + alt.Chart(sales_over_time).mark_line().encode(
-                x='invoicedate:T',
-                y=alt.Y('profit:Q', title='Profit'),
-                color=alt.value('green')
+                y=alt.Y('value:Q', title='Revenue / Profit'),
+                color=alt.Color(
+                    'metric:N',
+                    title=None,
+                    scale=alt.Scale(domain=['total_sale', 'profit'], range=['darkblue', 'green']),
+                    legend=alt.Legend(labelExpr="datum.label == 'total_sale' ? 'Revenue' : 'Profit'")
+                )
             ).interactive()
             st.altair_chart(chart, use_container_width=True)
 
         else:
-            st.warning("InvoiceDate column not found for time series chart.")
+            st.warning("No dated sales found for time series chart.")
 
     with col_chart2:
-        # 2. Top 10 Products by Qty (Filter NaN)
+        # 2. Top 10 Products by Qty (NaN descriptions filtered in SQL)
         st.subheader("Top 10 Products (by Quantity)")
-        # Filter out NaN descriptions before grouping
-        df_filtered_products = df.dropna(subset=['description'])
-        
-        top_products = df_filtered_products.groupby('description')['quantity'].sum().nlargest(10).reset_index(name='Total Quantity')
-        chart = alt.Chart(top_products).mark_bar().encode(
-            y=alt.Y('description', sort='-x', title='Product'),
-            x=alt.X('Total Quantity', title='Quantity Sold'),
-            tooltip=['description', 'Total Quantity']
-        ).properties(height=350)
-        st.altair_chart(chart, use_container_width=True)
+        top_products = load_top_products(10)
+
+        if not top_products.empty:
+            chart = alt.Chart(top_products).mark_bar().encode(
+                y=alt.Y('description', sort='-x', title='Product'),
+                x=alt.X('Total Quantity', title='Quantity Sold'),
+                tooltip=['description', 'Total Quantity']
+            ).properties(height=350)
+            st.altair_chart(chart, use_container_width=True)
+        else:
+            st.warning("No product data found.")
 
 
     col_chart3, col_chart4 = st.columns(2)
@@ -156,25 +274,25 @@ try:
     with col_chart3:
         # 3. Top 10 Countries by Profit (Changed from Revenue)
         st.subheader("Top 10 Countries (by Profit)")
-        # Group by Profit
-        sales_by_country = df.groupby('country')['profit'].sum().nlargest(10).reset_index(name='Total Profit')
-        chart = alt.Chart(sales_by_country).mark_bar().encode(
-            x=alt.X('Total Profit', title='Profit ($)'),
-            y=alt.Y('country', sort='-x', title='Country'),
-            color=alt.value('#E879F9'),
-            tooltip=['country', alt.Tooltip('Total Profit', format='$,.0f')]
-        ).properties(height=350)
-        st.altair_chart(chart, use_container_width=True)
+        sales_by_country = load_top_countries_by_profit(10)
+
+        if not sales_by_country.empty:
+            chart = alt.Chart(sales_by_country).mark_bar().encode(
+                x=alt.X('Total Profit', title='Profit ($)'),
+                y=alt.Y('country', sort='-x', title='Country'),
+                color=alt.value('#E879F9'),
+                tooltip=['country', alt.Tooltip('Total Profit', format='$,.0f')]
+            ).properties(height=350)
+            st.altair_chart(chart, use_container_width=True)
+        else:
+            st.warning("No country data found.")
 
     with col_chart4:
         # 4. Horizontal Bar Chart: Categories by Revenue (Filter 'unclassified')
         st.subheader("Top Categories (by Revenue)")
         
-        # Filter out 'unclassified' and NaN categories
-        df_filtered_category = df[(df['category'] != 'unclassified') & (df['category'].notna())]
-        
-        # Aggregate revenue and get top 10
-        sales_by_category = df_filtered_category.groupby('category')['total_sale'].sum().nlargest(10).reset_index(name='Total Revenue')
+        # 'unclassified' and NaN categories are filtered out in SQL
+        sales_by_category = load_top_categories(10)
         
         if not sales_by_category.empty:
             # Create Altair Horizontal Bar Chart, ordered largest to smallest
@@ -192,7 +310,9 @@ try:
 
     # --- Raw Data ---
     st.header("Raw Data Explorer")
-    st.dataframe(df, use_container_width=True)
+    raw_sample = load_raw_sample(5000)
+    st.caption(f"Showing the {len(raw_sample):,} most recent line items.")
+    st.dataframe(raw_sample, use_container_width=True)
     
 
 except Exception as e:
@@ -1,10 +1,16 @@
 # app/etl.py
 
+import csv
 import os
 import glob
-import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import adbc_driver_postgresql.dbapi as pg_adbc
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv
 from sqlalchemy import text
-from utils import get_db_engine, setup_logging
+from utils import get_adbc_uri, get_db_engine, setup_logging
 
 # Setup logger for this module
 logger = setup_logging()
@@ -12,11 +18,61 @@ logger = setup_logging()
 # Get data folder path from environment variable
 DATA_FOLDER = os.getenv('DATA_FOLDER', './data/')
 
+# Number of CSV files processed in parallel (defaults to one worker per CPU)
+ETL_WORKERS = int(os.getenv('ETL_WORKERS', os.cpu_count() or 1))
+
+# --- CSV Parsing Options ---
+# Column types are pinned while parsing (keyed by standardized column names).
+# Numbers and timestamps are read as text and parsed in transform_table, so a
+# dirty value becomes null (like pd.to_numeric(errors='coerce')) rather than
+# failing the conversion of the whole file.
+CSV_COLUMN_TYPES = {
+    'invoice': pa.string(),
+    'stockcode': pa.string(),
+    'description': pa.string(),
+    'quantity': pa.string(),
+    'invoicedate': pa.string(),
+    'price': pa.string(),
+    'customer_id': pa.string(),
+    'country': pa.string(),
+    'desc_low': pa.string(),
+    'category': pa.string(),
+    'margin': pa.string(),
+    'profit': pa.string()
+}
+
+# Numeric columns and the types they are parsed to; missing values default to 0
+NUMERIC_COLUMN_TYPES = {
+    'quantity': pa.int32(),
+    'price': pa.float64(),
+    'margin': pa.float64(),
+    'profit': pa.float64()
+}
+
+# Text that parses as a number (after trimming whitespace)
+NUMERIC_PATTERN = r'^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$'
+
+# String columns where missing values default to 'Unknown'
+STRING_COLS = ['invoice', 'stockcode', 'description', 'customer_id', 'country', 'desc_low', 'category']
+
+CSV_NULL_VALUES = ['', 'NA', 'N/A', 'NaN', 'nan', 'NULL', 'null']
+
+# invoicedate formats, tried in turn; offsets are converted to UTC
+TIMESTAMP_FORMATS = [
+    '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S%z', '%Y-%m-%d %H:%M%z',
+    '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S%z', '%Y-%m-%dT%H:%M%z',
+    '%Y-%m-%d', '%m/%d/%Y %H:%M', '%m/%d/%Y %H:%M:%S'
+]
+
+# Files are streamed in blocks of this many bytes, so memory use stays flat
+# however large the CSV is
+CSV_BLOCK_SIZE = 64 << 20 # 64 MiB
+
 # --- SQL Definitions ---
 # We use 'ecomm_sales' as the theme for our new tables.
 
-CREATE_STAGING_TABLE = """
-CREATE TABLE IF NOT EXISTS staging_ecomm_sales (
+CREATE_CORE_TABLE = """
+CREATE TABLE IF NOT EXISTS core_ecomm_sales (
     invoice VARCHAR(50),
     stockcode VARCHAR(50),
     description TEXT,
@@ -29,39 +85,79 @@ CREATE TABLE IF NOT EXISTS staging_ecomm_sales (
     category VARCHAR(100),
     margin DECIMAL(10, 4),
     profit DECIMAL(10, 2),
-    source_file VARCHAR(255)
+    -- Line revenue is precomputed on write so the dashboard can SUM it directly
+    total_sale NUMERIC(14, 2) GENERATED ALWAYS AS (quantity * price) STORED,
+    -- We create a composite primary key for deduplication
+    PRIMARY KEY (invoice, stockcode)
 );
 """
 
-CREATE_CORE_TABLE = """
-CREATE TABLE IF NOT EXISTS core_ecomm_sales (
-    -- We create a composite primary key for deduplication
-    line_item_id VARCHAR(100) PRIMARY KEY, 
-    invoice VARCHAR(50),
-    stockcode VARCHAR(50),
-    description TEXT,
-    quantity INT,
-    invoicedate TIMESTAMP WITH TIME ZONE,
-    price DECIMAL(10, 2),
-    customer_id VARCHAR(50),
-    country VARCHAR(100),
-    desc_low TEXT,
-    category VARCHAR(100),
-    margin DECIMAL(10, 4),
-    profit DECIMAL(10, 2)
-);
+# Moves core tables created with the old line_item_id key onto (invoice, stockcode).
+# line_item_id was CONCAT(invoice, '_', stockcode), so existing rows are already unique.
+MIGRATE_CORE_PRIMARY_KEY = """
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = current_schema()
+          AND table_name = 'core_ecomm_sales'
+          AND column_name = 'line_item_id'
+    ) THEN
+        ALTER TABLE core_ecomm_sales DROP COLUMN line_item_id;
+        ALTER TABLE core_ecomm_sales ADD PRIMARY KEY (invoice, stockcode);
+    END IF;
+END $$;
+"""
+
+# Drops the staging table earlier versions loaded through. Files now go straight
+# into core via a per-file temp table, so nothing reads or writes it any more.
+DROP_STAGING_TABLE = """
+DROP TABLE IF EXISTS staging_ecomm_sales;
+"""
+
+# Adds the generated column to core tables created before it existed.
+# The catalog check comes first because ALTER TABLE takes an ACCESS EXCLUSIVE lock
+# (blocking dashboard reads) even when ADD COLUMN IF NOT EXISTS ends up doing nothing.
+ADD_CORE_TOTAL_SALE = """
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = current_schema()
+          AND table_name = 'core_ecomm_sales'
+          AND column_name = 'total_sale'
+    ) THEN
+        ALTER TABLE core_ecomm_sales
+            ADD COLUMN total_sale NUMERIC(14, 2) GENERATED ALWAYS AS (quantity * price) STORED;
+    END IF;
+END $$;
 """
 
-# This query inserts data from staging to core.
-# We create the line_item_id on the fly using CONCAT.
-# ON CONFLICT (line_item_id) DO NOTHING handles deduplication.
-INSERT_FROM_STAGING = """
+# Indexes backing the dashboard's sort and GROUP BY columns.
+# The category index is partial to match the dashboard's 'unclassified' filter.
+CREATE_CORE_INDEXES = """
+CREATE INDEX IF NOT EXISTS idx_core_invoicedate ON core_ecomm_sales (invoicedate DESC);
+CREATE INDEX IF NOT EXISTS idx_core_country ON core_ecomm_sales (country);
+CREATE INDEX IF NOT EXISTS idx_core_category ON core_ecomm_sales (category) WHERE category <> 'unclassified';
+"""
+
+# Each file is ingested into a session-local temp table, _load_batch, and merged
+# into core in the same transaction, so there is no persistent staging table to truncate.
+# ADBC creates the temp table from the Arrow schema of the batches. Temp tables are
+# private to their session, so concurrent loads don't contend, and it is dropped
+# when the per-file connection closes.
+
+# This query moves the batch into core, casting to the core column types.
+# ON CONFLICT (invoice, stockcode) DO NOTHING handles deduplication.
+# Rows are inserted in key order, so concurrent per-file loads lock
+# overlapping keys in the same order and can't deadlock each other.
+# total_sale is a generated column, so it is left out of the column list.
+INSERT_FROM_LOAD_BATCH = """
 INSERT INTO core_ecomm_sales (
-    line_item_id, invoice, stockcode, description, quantity, 
-    invoicedate, price, customer_id, country, desc_low, category, margin, profit
+    invoice, stockcode, description, quantity, invoicedate, 
+    price, customer_id, country, desc_low, category, margin, profit
 )
 SELECT
-    CONCAT(invoice, '_', stockcode) AS line_item_id,
     invoice,
     stockcode,
     description,
@@ -74,22 +170,32 @@ SELECT
     category,
     margin,
     profit
-FROM staging_ecomm_sales
-ON CONFLICT (line_item_id) DO NOTHING;
+FROM _load_batch
+ORDER BY invoice, stockcode
+ON CONFLICT (invoice, stockcode) DO NOTHING;
 """
 
-TRUNCATE_STAGING = "TRUNCATE TABLE staging_ecomm_sales;"
+# SQLAlchemy statements are built once at import time and reused on every call.
+# (The load-batch statement above runs on an ADBC cursor and needs no wrapping.)
+_STMT_CREATE_CORE_TABLE = text(CREATE_CORE_TABLE)
+_STMT_MIGRATE_CORE_PRIMARY_KEY = text(MIGRATE_CORE_PRIMARY_KEY)
+_STMT_DROP_STAGING_TABLE = text(DROP_STAGING_TABLE)
+_STMT_ADD_CORE_TOTAL_SALE = text(ADD_CORE_TOTAL_SALE)
+_STMT_CREATE_CORE_INDEXES = text(CREATE_CORE_INDEXES)
 
 # --- ETL Functions ---
 
 def create_tables(engine):
-    """Creates the staging and core tables if they don't exist."""
+    """Creates the core table and its indexes if they don't exist."""
     try:
         with engine.connect() as conn:
-            conn.execute(text(CREATE_STAGING_TABLE))
-            conn.execute(text(CREATE_CORE_TABLE))
+            conn.execute(_STMT_CREATE_CORE_TABLE)
+            conn.execute(_STMT_MIGRATE_CORE_PRIMARY_KEY)
+            conn.execute(_STMT_DROP_STAGING_TABLE)
+            conn.execute(_STMT_ADD_CORE_TOTAL_SALE)
+            conn.execute(_STMT_CREATE_CORE_INDEXES)
             conn.commit()
-        logger.info("Staging and Core e-commerce tables verified/created.")
+        logger.info("Core e-commerce table and indexes verified/created.")
     except Exception as e:
         logger.error(f"Error creating tables: {e}")
         raise
@@ -101,75 +207,121 @@ def find_csv_files(folder_path):
     logger.info(f"Found {len(files)} CSV files in {folder_path}.")
     return files
 
-def process_file_to_staging(filepath, engine):
-    """Reads a single CSV, transforms it, and loads it to the staging table."""
+def open_csv_arrow(filepath):
+    """Opens a streaming Arrow reader over a CSV, with standardized column names and pinned types."""
+    # Standardize column names (lowercase, replace spaces with _) up front,
+    # e.g., "Customer ID" becomes "customer_id", so CSV_COLUMN_TYPES can match them
+    with open(filepath, newline='', encoding='utf-8-sig') as f:
+        header = next(csv.reader(f), None)
+    if header is None:
+        raise ValueError("empty file")
+    column_names = [col.lower().replace(' ', '_') for col in header]
+
+    read_options = pa.csv.ReadOptions(column_names=column_names, skip_rows=1, block_size=CSV_BLOCK_SIZE)
+    convert_options = pa.csv.ConvertOptions(
+        column_types=CSV_COLUMN_TYPES,
+        # Only parse the columns we load
+        include_columns=[col for col in column_names if col in CSV_COLUMN_TYPES],
+        null_values=CSV_NULL_VALUES,
+        strings_can_be_null=True
+    )
+    return pa.csv.open_csv(filepath, read_options=read_options, convert_options=convert_options)
+
+def parse_numeric(values, to_type):
+    """Parses text to numbers like pd.to_numeric(errors='coerce'): anything else becomes null."""
+    values = pc.utf8_trim_whitespace(values)
+    values = pc.if_else(pc.match_substring_regex(values, NUMERIC_PATTERN), values, None)
+    numbers = pc.cast(values, pa.float64())
+    # Overflowing values like '1e400' come out infinite, which no core column can hold
+    numbers = pc.if_else(pc.is_finite(numbers), numbers, None)
+    if pa.types.is_integer(to_type):
+        numbers = pc.trunc(numbers) # As astype(int) did
+    return pc.cast(numbers, to_type)
+
+def parse_timestamp(values):
+    """Parses text in any of TIMESTAMP_FORMATS to naive UTC timestamps; anything else becomes null."""
+    values = pc.utf8_trim_whitespace(values)
+    # strptime has no fractional seconds or 'Z' suffix, so drop the one and spell out the other
+    values = pc.replace_substring_regex(values, r'(:\d{2})\.\d+', r'\1')
+    values = pc.replace_substring_regex(values, r'Z$', '+0000')
+
+    parsed = None
+    for fmt in TIMESTAMP_FORMATS:
+        # Stop as soon as every value has parsed, which is usually after the first format
+        if parsed is not None and parsed.null_count == values.null_count:
+            break
+        attempt = pc.cast(pc.strptime(values, format=fmt, unit='us', error_is_null=True), pa.timestamp('us'))
+        parsed = attempt if parsed is None else pc.coalesce(parsed, attempt)
+    return parsed
+
+def transform_table(table):
+    """Applies the ETL transformations to a block of rows and returns it in core column order."""
+    # Add any core column the file doesn't have as nulls of its pinned type,
+    # so every file's batch has the full set of columns the merge selects
+    for col, col_type in CSV_COLUMN_TYPES.items():
+        if col not in table.column_names:
+            table = table.append_column(col, pa.nulls(table.num_rows, col_type))
+
+    # Parse the numeric and timestamp columns
+    for col, col_type in NUMERIC_COLUMN_TYPES.items():
+        idx = table.column_names.index(col)
+        table = table.set_column(idx, col, parse_numeric(table[col], col_type))
+    idx = table.column_names.index('invoicedate')
+    table = table.set_column(idx, 'invoicedate', parse_timestamp(table['invoicedate']))
+
+    # Default missing values (0 for numbers, 'Unknown' for strings)
+    # with Arrow compute kernels, one pass per column
+    fill_values = {col: 0 for col in NUMERIC_COLUMN_TYPES}
+    fill_values.update({col: 'Unknown' for col in STRING_COLS})
+    for col, value in fill_values.items():
+        idx = table.column_names.index(col)
+        table = table.set_column(idx, col, pc.fill_null(table[col], value))
+
+    # Ensure columns in the table match the core table order
+    core_cols = [
+        'invoice', 'stockcode', 'description', 'quantity', 'invoicedate', 
+        'price', 'customer_id', 'country', 'desc_low', 'category', 
+        'margin', 'profit'
+    ]
+    return table.select(core_cols)
+
+def transform_stream(reader):
+    """Wraps a streaming CSV reader so each block is transformed as it is pulled."""
+    # The output schema comes from transforming an empty table with the input schema
+    schema = transform_table(reader.schema.empty_table()).schema
+
+    def batches():
+        for batch in reader:
+            yield from transform_table(pa.Table.from_batches([batch])).to_batches()
+
+    return pa.RecordBatchReader.from_batches(schema, batches())
+
+def load_file_to_core(filepath, adbc_uri):
+    """Streams a single CSV through the transformations and loads its new rows into the core table."""
+    reader = None # Stays None if the file can't be opened, e.g. it is empty
     try:
         logger.info(f"Processing file: {filepath}")
-        df = pd.read_csv(filepath)
-        
-        # --- Transformation ---
-        # 1. Standardize column names (lowercase, replace spaces with _)
-        #    e.g., "Customer ID" becomes "customer_id"
-        df.columns = df.columns.str.lower().str.replace(' ', '_')
-
-        # 2. Ensure correct data types
-        #    This is crucial for SQL loading
-        df['invoicedate'] = pd.to_datetime(df['invoicedate'])
-        df['quantity'] = pd.to_numeric(df['quantity'], errors='coerce').fillna(0).astype(int)
-        df['price'] = pd.to_numeric(df['price'], errors='coerce').fillna(0)
-        df['margin'] = pd.to_numeric(df['margin'], errors='coerce').fillna(0)
-        df['profit'] = pd.to_numeric(df['profit'], errors='coerce').fillna(0)
-        
-        # 3. Handle potential nulls in string columns
-        str_cols = ['invoice', 'stockcode', 'description', 'customer_id', 'country', 'desc_low', 'category']
-        for col in str_cols:
-            if col in df.columns:
-                df[col] = df[col].astype(str).fillna('Unknown')
-
-        # 4. Add source file for tracking
-        df['source_file'] = os.path.basename(filepath)
-        
-        # --- Load to Staging ---
-        # Ensure columns in DF match the staging table order
-        staging_cols = [
-            'invoice', 'stockcode', 'description', 'quantity', 'invoicedate', 
-            'price', 'customer_id', 'country', 'desc_low', 'category', 
-            'margin', 'profit', 'source_file'
-        ]
-        
-        # Filter DF to only include columns that exist in the staging table
-        df_to_load = df[[col for col in staging_cols if col in df.columns]]
-
-        df_to_load.to_sql(
-            'staging_ecomm_sales',
-            con=engine,
-            if_exists='append', # Add data to the table
-            index=False,
-            method='multi' # Efficiently insert rows in batches
-        )
-        logger.info(f"Loaded {len(df_to_load)} rows from {filepath} to staging_ecomm_sales.")
+        # Parse with pyarrow's multi-threaded reader, one block at a time
+        # Column names are standardized and data types pinned while parsing
+        reader = open_csv_arrow(filepath)
+
+        # Ingest the transformed blocks into a temp table as Arrow over PostgreSQL's
+        # binary COPY protocol (no CSV encoding), then merge it into core,
+        # all in one transaction on one connection
+        with pg_adbc.connect(adbc_uri) as conn: # Rolls back on failure
+            with conn.cursor() as cur:
+                loaded = cur.adbc_ingest('_load_batch', transform_stream(reader), mode='create', temporary=True)
+                cur.execute(INSERT_FROM_LOAD_BATCH)
+                inserted = cur.rowcount
+            conn.commit()
+
+        logger.info(f"Loaded {inserted} new rows (of {loaded}) from {filepath} to core_ecomm_sales.")
         
     except Exception as e:
         logger.error(f"Failed to process file {filepath}: {e}")
         # Log which columns were expected vs. found
-        logger.debug(f"File columns: {list(df.columns)}")
-
-def move_data_to_core(engine):
-    """Moves unique data from staging to core and truncates staging."""
-    try:
-        with engine.connect() as conn:
-            # 1. Insert unique records into core table
-            result = conn.execute(text(INSERT_FROM_STAGING))
-            conn.commit()
-            logger.info(f"Moved {result.rowcount} new rows from staging to core_ecomm_sales.")
-            
-            # 2. Clear staging table for next run
-            conn.execute(text(TRUNCATE_STAGING))
-            conn.commit()
-            logger.info("Staging table truncated.")
-    except Exception as e:
-        logger.error(f"Error moving data to core: {e}")
-        raise
+        if reader is not None:
+            logger.debug(f"File columns: {reader.schema.names}")
 
 # --- Main Execution ---
 def main():
@@ -186,12 +338,14 @@ def main():
             logger.warning(f"No CSV files found in {DATA_FOLDER}. Exiting.")
             return
 
-        # 3. Process each file into staging table
-        for f in csv_files:
-            process_file_to_staging(f, engine)
-        
-        # 4. Move data from staging to core (deduplication)
-        move_data_to_core(engine)
+        # 3. Load the files into the core table in parallel (with deduplication)
+        #    Workers only need the connection URI, as each file opens its own ADBC connection.
+        #    Drop the parent's pooled connections so the forked workers don't inherit them
+        adbc_uri = get_adbc_uri(engine)
+        engine.dispose()
+        max_workers = min(ETL_WORKERS, len(csv_files))
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(load_file_to_core, csv_files, repeat(adbc_uri)))
         
         logger.info("=== ETL Process Completed Successfully ===")
         
@@ -1,15 +1,24 @@
 # app/utils.py
 
+import io
 import logging
 import os
 import sys
+import pyarrow as pa
+import pyarrow.csv
 from sqlalchemy import create_engine
 from sqlalchemy.engine import Engine
 
 # --- Logging Setup ---
 
+# Cached so repeated calls don't construct (and open) new handlers
+_logger = None
+
 def setup_logging() -> logging.Logger:
-    """Configures and returns a root logger."""
+    """Configures the root logger on the first call and returns the app logger."""
+    global _logger
+    if _logger is not None:
+        return _logger
     
     # Configure logger to output to console and a file
     logging.basicConfig(
@@ -21,8 +30,11 @@ def setup_logging() -> logging.Logger:
         ]
     )
     
-    logger = logging.getLogger(__name__)
-    return logger
+    _logger = logging.getLogger('pos2etl')
+    return _logger
+
+# Setup logger for this module
+logger = setup_logging()
 
 # --- Database Connection ---
 
@@ -31,7 +43,6 @@ def get_db_engine() -> Engine:
     Creates and returns a SQLAlchemy engine using environment variables.
     Handles connection errors.
     """
-    logger = setup_logging()
     try:
         # Load database credentials from environment variables
         db_user = os.getenv('POSTGRES_USER')
@@ -49,7 +60,16 @@ def get_db_engine() -> Engine:
         connection_string = f"postgresql+psycopg2://{db_user}:{db_pass}@{db_host}:{db_port}/{db_name}"
         
         # Create and return the engine
-        engine = create_engine(connection_string)
+        # Pooled connections are pre-pinged and recycled, so ones the server dropped
+        # while idle are replaced transparently; TCP keepalives stop them going stale.
+        engine = create_engine(
+            connection_string,
+            pool_size=10,
+            max_overflow=5,
+            pool_pre_ping=True,
+            pool_recycle=1800, # Seconds
+            connect_args={'keepalives': 1, 'keepalives_idle': 30}
+        )
         
         # Test the connection
         with engine.connect() as conn:
@@ -59,4 +79,40 @@ def get_db_engine() -> Engine:
     
     except Exception as e:
         logger.error(f"Failed to create database engine: {e}")
-        sys.exit(1) # Exit the script if DB connection fails
\ No newline at end of file
+        sys.exit(1) # Exit the script if DB connection fails
+
+def get_adbc_uri(engine: Engine) -> str:
+    """Returns the engine's connection string in the plain libpq form ADBC expects."""
+    return engine.url.set(drivername='postgresql').render_as_string(hide_password=False)
+
+# --- Bulk Read ---
+
+def read_sql_arrow(query: str, engine: Engine, params: dict = None, column_types: dict = None) -> pa.Table:
+    """
+    Streams the result of a query out of PostgreSQL with COPY and parses it
+    into an Arrow table, skipping the row-by-row DBAPI fetch.
+    `params` are bound client-side (COPY itself takes no parameters) and
+    `column_types` maps column names to Arrow types to pin during parsing;
+    pin text columns to pa.string(), or digit-only values are inferred as integers.
+    """
+    # Borrow a raw psycopg2 connection from the engine's pool
+    raw_conn = engine.raw_connection()
+    try:
+        buf = io.BytesIO()
+        with raw_conn.cursor() as cur:
+            if params:
+                query = cur.mogrify(query, params).decode()
+            cur.copy_expert(f"COPY ({query}) TO STDOUT WITH CSV HEADER", buf)
+        buf.seek(0)
+
+        # Unquoted empty fields are NULLs in COPY's CSV format, quoted ones are empty strings.
+        # Nothing else is NULL, so text like 'NA' or 'null' is kept as-is
+        convert_options = pa.csv.ConvertOptions(
+            column_types=column_types or {},
+            null_values=[''],
+            strings_can_be_null=True,
+            quoted_strings_can_be_null=False
+        )
+        return pa.csv.read_csv(buf, convert_options=convert_options)
+    finally:
+        raw_conn.close() # Return the connection to the pool
\ No newline at end of file